@@ -1,10 +1,29 @@
-from unittest import TestCase
+import pickle
+from dataclasses import astuple, fields
+from unittest import TestCase, mock, skipUnless
 
+import torch
 from hypothesis import given
 from hypothesis import strategies as st
-from transformers import AutoTokenizer
+from torch.nn.utils.rnn import pad_sequence
+from transformers import AutoTokenizer, BatchEncoding
 
-from trlx.pipeline.offline_pipeline import DialogMessage, tokenize_dialogue
+from trlx.data.ilql_types import ILQLBatch, ILQLSeq2SeqBatch
+from trlx.pipeline import offline_pipeline
+from trlx.pipeline.offline_pipeline import (
+    DialogMessage,
+    DialogStore,
+    DialogStreamStore,
+    ILQLRolloutStorage,
+    ILQLSeq2SeqRolloutStorage,
+    PromptMessage,
+    PromptPipeline,
+    ilql_collate_fn,
+    ilql_seq2seq_collate_fn,
+    middle_char_token_ids,
+    middle_truncate,
+    tokenize_dialogue,
+)
 
 
 class TestTokenizeDialog(TestCase):
@@ -21,74 +40,72 @@ class TestTokenizeDialog(TestCase):
         user_dm, bot_dm = dialog
         assert len(user_dm.tokens) == 1
         assert len(bot_dm.tokens) == 1
-        assert user_dm == DialogMessage(is_output=False, tokens=(self.tokenizer.bos_token_id,))
-        assert bot_dm == DialogMessage(is_output=True, tokens=(self.tokenizer.eos_token_id,))
+        assert user_dm == DialogMessage(is_output=False, tokens=[self.tokenizer.bos_token_id])
+        assert bot_dm == DialogMessage(is_output=True, tokens=[self.tokenizer.eos_token_id])
 
     @given(st.lists(st.text(), max_size=32))
     def test_tokenize_dialogue_single_turn(self, response_words):
         response = " ".join(response_words)  # space seperate to make it multiple tokens
-        tokenized_response = tuple(self.tokenizer(response, add_special_tokens=False).input_ids)
-        tokenized_response = tokenized_response + (self.tokenizer.eos_token_id,)
+        tokenized_response = self.tokenizer(response, add_special_tokens=False).input_ids
+        tokenized_response = tokenized_response + [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(response, self.tokenizer)
 
         assert len(dialog) == 2
         user_dm, bot_dm = dialog
 
-        assert user_dm == DialogMessage(is_output=False, tokens=(self.tokenizer.bos_token_id,))
+        assert user_dm == DialogMessage(is_output=False, tokens=[self.tokenizer.bos_token_id])
         assert bot_dm == DialogMessage(is_output=True, tokens=tokenized_response)
 
     @given(st.lists(st.text(), max_size=32), st.integers(min_value=2, max_value=16))
     def test_tokenize_dialogue_single_turn_truncation_right(self, response_words, max_length):
         response = " ".join(response_words)  # space seperate to make it multiple tokens
         self.tokenizer.truncation_side = "right"
-        tokenized_response = tuple(self.tokenizer(response, add_special_tokens=False).input_ids)
-        tokenized_response = tokenized_response + (self.tokenizer.eos_token_id,)
+        tokenized_response = self.tokenizer(response, add_special_tokens=False).input_ids
+        tokenized_response = tokenized_response + [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(response, self.tokenizer, max_length=max_length)
 
         assert len(dialog) == 2
         user_dm, bot_dm = dialog
 
-        assert user_dm == DialogMessage(is_output=False, tokens=(self.tokenizer.bos_token_id,))
+        assert user_dm == DialogMessage(is_output=False, tokens=[self.tokenizer.bos_token_id])
         assert bot_dm == DialogMessage(is_output=True, tokens=tokenized_response[: max_length - 1])
 
-        all_tokens = sum((dm.tokens for dm in dialog), ())
+        all_tokens = sum((dm.tokens for dm in dialog), [])
         assert len(all_tokens) <= max_length
 
     @given(st.lists(st.text(), max_size=32), st.integers(min_value=2, max_value=16))
     def test_tokenize_dialogue_single_turn_truncation_left(self, response_words, max_length):
         response = " ".join(response_words)  # space seperate to make it multiple tokens
         self.tokenizer.truncation_side = "left"
-        tokenized_response = tuple(self.tokenizer(response, add_special_tokens=False).input_ids)
-        tokenized_response += (self.tokenizer.eos_token_id,)
+        tokenized_response = self.tokenizer(response, add_special_tokens=False).input_ids
+        tokenized_response += [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(response, self.tokenizer, max_length=max_length)
 
         # whether or not truncation has happened, user BOS prompt should be present
         assert len(dialog) == 2
         user_dm, bot_dm = dialog
-        assert user_dm == DialogMessage(is_output=False, tokens=(self.tokenizer.bos_token_id,))
+        assert user_dm == DialogMessage(is_output=False, tokens=[self.tokenizer.bos_token_id])
 
         if len(tokenized_response) < max_length:
             assert bot_dm == DialogMessage(is_output=True, tokens=tokenized_response)
         else:
             assert bot_dm == DialogMessage(is_output=True, tokens=tokenized_response[-max_length + 1 :])
 
-        all_tokens = sum((dm.tokens for dm in dialog), ())
+        all_tokens = sum((dm.tokens for dm in dialog), [])
         assert len(all_tokens) <= max_length
 
     @given(st.lists(st.tuples(st.text(), st.text()), min_size=1, max_size=32))
     def test_tokenize_dialogue_multi_turn(self, user_response_pairs):
         convo = [[" ".join(user_words), " ".join(response_words)] for user_words, response_words in user_response_pairs]
         flat_convo = sum(convo, [])
-        tokenized_flat_convo = tuple(
-            tuple(self.tokenizer(turn, add_special_tokens=False).input_ids) for turn in flat_convo
-        )
-        tokenized_flat_convo = (*tokenized_flat_convo[:-1], (*tokenized_flat_convo[-1], self.tokenizer.eos_token_id))
+        tokenized_flat_convo = [self.tokenizer(turn, add_special_tokens=False).input_ids for turn in flat_convo]
+        tokenized_flat_convo[-1] = tokenized_flat_convo[-1] + [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(flat_convo, self.tokenizer)
 
         dm_convo = [DialogMessage(is_output=i % 2 == 1, tokens=tokens) for i, tokens in enumerate(tokenized_flat_convo)]
         nonempty_dm_convo = [dm for dm in dm_convo if dm.tokens]
         if nonempty_dm_convo[0].is_output:
-            nonempty_dm_convo.insert(0, DialogMessage(is_output=False, tokens=(self.tokenizer.eos_token_id,)))
+            nonempty_dm_convo.insert(0, DialogMessage(is_output=False, tokens=[self.tokenizer.eos_token_id]))
 
         assert dialog == nonempty_dm_convo
 
@@ -97,16 +114,14 @@ class TestTokenizeDialog(TestCase):
         convo = [[" ".join(user_words), " ".join(response_words)] for user_words, response_words in user_response_pairs]
         flat_convo = sum(convo, [])
         self.tokenizer.truncation_side = "right"
-        tokenized_flat_convo = tuple(
-            tuple(self.tokenizer(turn, add_special_tokens=False).input_ids) for turn in flat_convo
-        )
-        tokenized_flat_convo = (*tokenized_flat_convo[:-1], (*tokenized_flat_convo[-1], self.tokenizer.eos_token_id))
+        tokenized_flat_convo = [self.tokenizer(turn, add_special_tokens=False).input_ids for turn in flat_convo]
+        tokenized_flat_convo[-1] = tokenized_flat_convo[-1] + [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(flat_convo, self.tokenizer, max_length=max_length)
 
-        all_tokens = sum((dm.tokens for dm in dialog), ())
-        should_be_tokens = sum(tokenized_flat_convo, ())[:max_length]
-        if dialog[0] == DialogMessage(is_output=False, tokens=(self.tokenizer.eos_token_id,)):
-            should_be_tokens = (self.tokenizer.eos_token_id, *should_be_tokens[: max_length - 1])
+        all_tokens = sum((dm.tokens for dm in dialog), [])
+        should_be_tokens = sum(tokenized_flat_convo, [])[:max_length]
+        if dialog[0] == DialogMessage(is_output=False, tokens=[self.tokenizer.eos_token_id]):
+            should_be_tokens = [self.tokenizer.eos_token_id, *should_be_tokens[: max_length - 1]]
 
         assert all_tokens == should_be_tokens
         assert len(all_tokens) <= max_length
@@ -116,16 +131,368 @@ class TestTokenizeDialog(TestCase):
         convo = [[" ".join(user_words), " ".join(response_words)] for user_words, response_words in user_response_pairs]
         flat_convo = sum(convo, [])
         self.tokenizer.truncation_side = "left"
-        tokenized_flat_convo = tuple(
-            tuple(self.tokenizer(turn, add_special_tokens=False).input_ids) for turn in flat_convo
-        )
-        tokenized_flat_convo = (*tokenized_flat_convo[:-1], (*tokenized_flat_convo[-1], self.tokenizer.eos_token_id))
+        tokenized_flat_convo = [self.tokenizer(turn, add_special_tokens=False).input_ids for turn in flat_convo]
+        tokenized_flat_convo[-1] = tokenized_flat_convo[-1] + [self.tokenizer.eos_token_id]
         dialog = tokenize_dialogue(flat_convo, self.tokenizer, max_length=max_length)
 
-        all_tokens = sum((dm.tokens for dm in dialog), ())
-        should_be_tokens = sum(tokenized_flat_convo, ())[-max_length:]
-        if dialog[0] == DialogMessage(is_output=False, tokens=(self.tokenizer.eos_token_id,)):
-            should_be_tokens = (self.tokenizer.eos_token_id, *should_be_tokens[-max_length + 1 :])
+        all_tokens = sum((dm.tokens for dm in dialog), [])
+        should_be_tokens = sum(tokenized_flat_convo, [])[-max_length:]
+        if dialog[0] == DialogMessage(is_output=False, tokens=[self.tokenizer.eos_token_id]):
+            should_be_tokens = [self.tokenizer.eos_token_id, *should_be_tokens[-max_length + 1 :]]
 
         assert all_tokens == should_be_tokens
         assert len(all_tokens) <= max_length
+
+
+def reference_middle_truncate(tokens, max_length, output_length, truncation_side, start_id, end_id, sep_id):
+    """
+    Positions of `tokens` kept by middle truncation, dropping separated chunks of the middle part one at a time,
+    or None if even an empty middle part does not fit
+    """
+    if len(tokens) + output_length <= max_length:
+        return list(range(len(tokens)))
+
+    start_ix = tokens.index(start_id) if start_id in tokens else -1
+    end_ix = tokens.index(end_id, start_ix + 1) if end_id in tokens[start_ix + 1 :] else -1
+    if start_ix == -1 or end_ix == -1:
+        start_ix, end_ix = 0, len(tokens) - 1
+
+    middle = list(range(start_ix + 1, end_ix))
+    middle_max_length = max_length - output_length - (len(tokens) - len(middle))
+    if middle_max_length < 0:
+        return None
+
+    if truncation_side == "middle-right":
+        middle = middle[::-1]
+    while len(middle) > middle_max_length:
+        sep_ixs = [ix for ix, position in enumerate(middle) if tokens[position] == sep_id]
+        if not sep_ixs:
+            middle = []
+            break
+        middle = middle[sep_ixs[0] + 1 :]
+    if truncation_side == "middle-right":
+        middle = middle[::-1]
+
+    return list(range(start_ix + 1)) + middle + list(range(end_ix, len(tokens)))
+
+
+class TestMiddleTruncate(TestCase):
+    # token ids of the start, end and separator chars
+    start_id, end_id, sep_id = 1, 2, 3
+
+    def truncate(self, tokenized, max_length, truncation_side):
+        middle_truncate(tokenized, max_length, truncation_side, self.start_id, self.end_id, self.sep_id)
+
+    @given(
+        st.lists(st.integers(min_value=0, max_value=5), min_size=2, max_size=48),
+        st.integers(min_value=1, max_value=48),
+        st.sampled_from(["middle-left", "middle-right"]),
+    )
+    def test_middle_truncate_prompt(self, tokens, max_length, truncation_side):
+        # the mask records original positions to check that it stays aligned with the tokens
+        tokenized = [PromptMessage(tokens=list(tokens), mask=list(range(len(tokens))))]
+        positions = reference_middle_truncate(
+            tokens, max_length, 0, truncation_side, self.start_id, self.end_id, self.sep_id
+        )
+
+        if positions is None:
+            with self.assertRaises(RuntimeError):
+                self.truncate(tokenized, max_length, truncation_side)
+            return
+
+        self.truncate(tokenized, max_length, truncation_side)
+        assert tokenized[0].mask == positions
+        assert tokenized[0].tokens == [tokens[position] for position in positions]
+
+    @given(
+        st.lists(st.integers(min_value=0, max_value=5), min_size=2, max_size=48),
+        st.lists(st.integers(min_value=0, max_value=5), max_size=8),
+        st.integers(min_value=1, max_value=48),
+        st.sampled_from(["middle-left", "middle-right"]),
+    )
+    def test_middle_truncate_dialog(self, prompt_tokens, output_tokens, max_length, truncation_side):
+        tokenized = [DialogMessage(False, list(prompt_tokens)), DialogMessage(True, list(output_tokens))]
+        positions = reference_middle_truncate(
+            prompt_tokens, max_length, len(output_tokens), truncation_side, self.start_id, self.end_id, self.sep_id
+        )
+
+        if positions is None:
+            with self.assertRaises(RuntimeError):
+                self.truncate(tokenized, max_length, truncation_side)
+            return
+
+        self.truncate(tokenized, max_length, truncation_side)
+        assert tokenized[0].tokens == [prompt_tokens[position] for position in positions]
+        # outputs are never truncated
+        assert tokenized[1].tokens == output_tokens
+
+    def test_middle_truncate_end_before_start(self):
+        # the end char only precedes the start char, so the whole prompt between its first and last token is
+        # treated as the middle part
+        tokens = [2, 4, 3, 4, 1, 4, 3, 4]
+        tokenized = [PromptMessage(tokens=list(tokens), mask=list(range(len(tokens))))]
+        self.truncate(tokenized, 5, "middle-left")
+
+        assert tokenized[0].tokens == [2, 4]
+        assert tokenized[0].mask == [0, 7]
+
+        tokenized = [PromptMessage(tokens=list(tokens), mask=list(range(len(tokens))))]
+        self.truncate(tokenized, 6, "middle-right")
+
+        assert tokenized[0].tokens == [2, 4, 4]
+        assert tokenized[0].mask == [0, 1, 7]
+
+    @given(
+        st.lists(st.text(alphabet="abcdef", min_size=1, max_size=8), min_size=1, max_size=16),
+        st.integers(min_value=8, max_value=48),
+        st.sampled_from(["middle-left", "middle-right"]),
+    )
+    def test_tokenize_dialogue_middle_truncation(self, chunks, max_length, truncation_side):
+        tokenizer = AutoTokenizer.from_pretrained("gpt2")
+        tokenizer.init_kwargs.update(middle_start_char="<", middle_end_char=">", middle_sep_char="|")
+        tokenizer.truncation_side = truncation_side
+        start_id, end_id, sep_id = middle_char_token_ids(tokenizer)
+
+        prompt = "x<" + "|".join(chunks) + ">y"
+        prompt_tokens = tokenizer(prompt, add_special_tokens=False).input_ids
+        output_tokens = tokenizer("ok" + tokenizer.eos_token, add_special_tokens=False).input_ids
+        positions = reference_middle_truncate(
+            prompt_tokens, max_length, len(output_tokens), truncation_side, start_id, end_id, sep_id
+        )
+
+        if positions is None:
+            with self.assertRaises(RuntimeError):
+                tokenize_dialogue([prompt, "ok"], tokenizer, max_length=max_length)
+            return
+
+        dialog = tokenize_dialogue([prompt, "ok"], tokenizer, max_length=max_length)
+        assert dialog == [
+            DialogMessage(is_output=False, tokens=[prompt_tokens[position] for position in positions]),
+            DialogMessage(is_output=True, tokens=output_tokens),
+        ]
+        assert sum(len(dm.tokens) for dm in dialog) <= max_length
+
+
+class TestDialogStore(TestCase):
+    def setUp(self):
+        self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def test_create_loader_padding(self):
+        dialogs = [
+            ["a short prompt", " and output"],
+            ["a much longer prompt spanning quite a few more tokens", " and a longer output", " again", "!"],
+            ["hi", "."],
+        ]
+        dialogs = [tokenize_dialogue(d, self.tokenizer, max_length=64) for d in dialogs]
+
+        for padding_side in ["right", "left"]:
+            self.tokenizer.padding_side = padding_side
+            store = DialogStore(dialogs, self.tokenizer)
+            batch = next(iter(store.create_loader(batch_size=len(dialogs))))
+            max_length = max(len(record["input_ids"]) for record in store.history)
+
+            for ix, record in enumerate(store.history):
+                length = len(record["input_ids"])
+                if padding_side == "right":
+                    span, padding = slice(0, length), slice(length, max_length)
+                else:
+                    span, padding = slice(max_length - length, max_length), slice(0, max_length - length)
+
+                assert batch.input_ids[ix, span].tolist() == record["input_ids"].tolist()
+                assert batch.attention_mask[ix, span].tolist() == [1] * length
+                assert batch.labels[ix, span].tolist() == record["labels"].tolist()
+
+                assert batch.input_ids[ix, padding].tolist() == [self.tokenizer.pad_token_id] * (max_length - length)
+                assert batch.attention_mask[ix, padding].tolist() == [0] * (max_length - length)
+                assert batch.labels[ix, padding].tolist() == [-100] * (max_length - length)
+
+    def test_build_processes(self):
+        dialogs = [["a prompt", " an output"], ["another prompt", " another output", " again", "!"], ["hi", "."]]
+        dialogs = [tokenize_dialogue(d, self.tokenizer, max_length=64) for d in dialogs]
+
+        store = DialogStore(dialogs, self.tokenizer)
+        parallel_store = DialogStore(dialogs, self.tokenizer, build_processes=2)
+
+        assert len(parallel_store) == len(store)
+        for record, parallel_record in zip(store.history, parallel_store.history):
+            for name, value in record.items():
+                assert torch.equal(parallel_record[name], value)
+
+
+class TestDialogStreamStore(TestCase):
+    def setUp(self):
+        self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
+
+    def test_cache(self):
+        dialogs = [["a prompt", " an output"], ["another prompt", " another output"], ["hi", "."]]
+        store = DialogStreamStore(dialogs, len(dialogs), self.tokenizer, seq_length=64, cache_size=2)
+        uncached_store = DialogStreamStore(dialogs, len(dialogs), self.tokenizer, seq_length=64)
+
+        with mock.patch.object(store, "_getitem", wraps=store._getitem) as getitem:
+            for ix in [0, 1, 0, 2, 1, 0]:
+                for name, value in store[ix].items():
+                    assert torch.equal(value, uncached_store[ix][name])
+        # only the third access is a hit, the others miss or follow an eviction
+        assert getitem.call_count == 5
+
+        # the cache does not prevent sending the store to dataloader workers
+        unpickled_store = pickle.loads(pickle.dumps(store))
+        for name, value in unpickled_store[0].items():
+            assert torch.equal(value, store[0][name])
+
+
+class TestPromptPipeline(TestCase):
+    def setUp(self):
+        self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
+        self.tokenizer.truncation_side = "left"
+
+    def test_repeated_prompts(self):
+        prompts = ["first prompt", "a second, longer prompt", "first prompt", "third", "a second, longer prompt"]
+
+        for max_prompt_length in [3, 16]:
+            metadata = [{"prompt": prompt, "ix": ix} for ix, prompt in enumerate(prompts)]
+            pipeline = PromptPipeline(metadata, max_prompt_length, self.tokenizer)
+
+            assert len(pipeline) == len(prompts)
+            for ix, prompt in enumerate(prompts):
+                input_ids = self.tokenizer(prompt).input_ids[-max_prompt_length:]
+                assert pipeline[ix] == {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "ix": ix}
+
+    def test_create_loader_padding(self):
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        prompts = ["a short prompt", "a much longer prompt spanning quite a few more tokens", "hi"]
+        metadata = [{"prompt": prompt, "ix": ix, "original_output": prompt[::-1]} for ix, prompt in enumerate(prompts)]
+        pipeline = PromptPipeline(metadata, 64, self.tokenizer)
+
+        for padding_side in ["right", "left"]:
+            self.tokenizer.padding_side = padding_side
+            batch = next(iter(pipeline.create_loader(batch_size=len(prompts))))
+
+            assert isinstance(batch, BatchEncoding)
+            assert batch["ix"] == list(range(len(prompts)))
+            assert batch["original_output"] == [prompt[::-1] for prompt in prompts]
+
+            max_length = max(len(pipeline[ix]["input_ids"]) for ix in range(len(prompts)))
+            for ix in range(len(prompts)):
+                input_ids = pipeline[ix]["input_ids"]
+                length = len(input_ids)
+                if padding_side == "right":
+                    span, padding = slice(0, length), slice(length, max_length)
+                else:
+                    span, padding = slice(max_length - length, max_length), slice(0, max_length - length)
+
+                assert batch.input_ids[ix, span].tolist() == input_ids
+                assert batch.attention_mask[ix, span].tolist() == [1] * length
+                assert batch.input_ids[ix, padding].tolist() == [self.tokenizer.pad_token_id] * (max_length - length)
+                assert batch.attention_mask[ix, padding].tolist() == [0] * (max_length - length)
+
+            # same as padding with the tokenizer
+            expected = self.tokenizer.pad(
+                [{"input_ids": pipeline[ix]["input_ids"]} for ix in range(len(prompts))], return_tensors="pt"
+            )
+            assert torch.equal(batch.input_ids, expected.input_ids)
+            assert torch.equal(batch.attention_mask, expected.attention_mask)
+
+    def test_cache_encodings(self):
+        prompts = ["first prompt", "a second, longer prompt", "first prompt"]
+        pipeline = PromptPipeline(prompts, 4, self.tokenizer, cache_encodings=True)
+
+        # every prompt is cached, so the tokenizer is not called again
+        with mock.patch.object(type(self.tokenizer), "__call__", side_effect=AssertionError):
+            cached_pipeline = PromptPipeline(prompts, 4, self.tokenizer, cache_encodings=True)
+
+        for ix in range(len(prompts)):
+            assert cached_pipeline[ix] == pipeline[ix]
+
+        # pipelines do not share the cached encodings
+        pipeline[0]["input_ids"].append(-1)
+        assert cached_pipeline[0]["input_ids"] == self.tokenizer(prompts[0]).input_ids[-4:]
+
+        # encodings of another tokenizer with the same name are not reused
+        tokenizer = AutoTokenizer.from_pretrained("gpt2")
+        tokenizer.truncation_side = "left"
+        tokenizer.add_tokens(["second"])
+        other_pipeline = PromptPipeline(prompts, 4, tokenizer, cache_encodings=True)
+        assert other_pipeline[1]["input_ids"] == tokenizer(prompts[1]).input_ids[-4:]
+        assert other_pipeline[1]["input_ids"] != cached_pipeline[1]["input_ids"]
+
+
+class TestILQLBatch(TestCase):
+    @skipUnless(torch.cuda.is_available(), "pinning memory requires CUDA")
+    def test_pin_memory(self):
+        for batch_type in [ILQLBatch, ILQLSeq2SeqBatch]:
+            batch = batch_type(*(torch.randint(0, 100, (4, 8)) for _ in fields(batch_type)))
+            pinned = batch.pin_memory()
+
+            assert isinstance(pinned, batch_type)
+            for f in fields(batch_type):
+                assert getattr(pinned, f.name).is_pinned()
+                assert torch.equal(getattr(pinned, f.name), getattr(batch, f.name))
+
+
+class TestILQLRolloutStorage(TestCase):
+    def create_rollouts(self, num_samples, seq2seq=False):
+        rollouts = {"input_ids": [], "attention_mask": []}
+        if seq2seq:
+            rollouts["decoder_input_ids"] = []
+        rollouts.update({"rewards": [], "states_ixs": [], "actions_ixs": [], "dones": []})
+
+        for ix in range(num_samples):
+            input_length, actions_length = torch.randint(1, 16, (2,)).tolist()
+            # the first token identifies the sample in a shuffled batch
+            rollouts["input_ids"].append(torch.cat((torch.tensor([ix]), torch.randint(0, 100, (input_length - 1,)))))
+            rollouts["attention_mask"].append(torch.ones(input_length, dtype=torch.long))
+            if seq2seq:
+                rollouts["decoder_input_ids"].append(torch.randint(0, 100, (actions_length + 1,)))
+            rollouts["rewards"].append(torch.randn(actions_length))
+            rollouts["states_ixs"].append(torch.randint(0, 100, (actions_length + 1,)))
+            rollouts["actions_ixs"].append(torch.randint(0, 100, (actions_length,)))
+            rollouts["dones"].append(torch.tensor([1] * actions_length + [0]))
+
+        return rollouts
+
+    def check_storage(self, storage_type, collate_fn, seq2seq):
+        rollouts = self.create_rollouts(37, seq2seq=seq2seq)
+        storage = storage_type(**rollouts)
+        assert len(storage) == 37
+
+        # single elements are the original unpadded rows
+        for ix in range(len(storage)):
+            for value, row in zip(astuple(storage[ix]), (rows[ix] for rows in rollouts.values())):
+                assert torch.equal(value, row)
+
+        # batches are padded once by the collate function, without padding each field separately
+        with mock.patch.object(
+            offline_pipeline, "_pad_elements", wraps=offline_pipeline._pad_elements
+        ) as pad_elements, mock.patch("torch.nn.utils.rnn.pad_sequence", side_effect=AssertionError):
+            batches = list(storage.create_loader(batch_size=8))
+        assert pad_elements.call_count == len(batches)
+
+        n_samples = 0
+        for batch in batches:
+            ixs = batch.input_ids[:, 0].tolist()
+            n_samples += len(ixs)
+            # same as padding every field of the batch with `pad_sequence`
+            for name, rows in rollouts.items():
+                expected = pad_sequence([rows[ix] for ix in ixs], batch_first=True, padding_value=0)
+                assert torch.equal(getattr(batch, name), expected)
+
+            # element-wise collation gives the same batch
+            elementwise_batch = collate_fn([storage[ix] for ix in ixs])
+            for f in fields(batch):
+                assert torch.equal(getattr(elementwise_batch, f.name), getattr(batch, f.name))
+
+        assert n_samples == len(storage)
+        # nothing is moved into shared memory without worker processes
+        assert not storage.input_ids.is_shared()
+
+        storage.create_loader(batch_size=8, num_workers=1)
+        for name in storage.offsets:
+            assert getattr(storage, name).is_shared()
+
+    def test_ilql_rollout_storage(self):
+        self.check_storage(ILQLRolloutStorage, ilql_collate_fn, seq2seq=False)
+
+    def test_ilql_seq2seq_rollout_storage(self):
+        self.check_storage(ILQLSeq2SeqRolloutStorage, ilql_seq2seq_collate_fn, seq2seq=True)
@@ -205,6 +205,19 @@ class TrainConfig:
     :param data_size: Size of data size when data_type=`stream`
     :type data_size: int
 
+    :param data_cache_size: Number of tokenized samples to cache when data_type=`stream`, disabled by default.
+        Every cached sample takes up to three `seq_length` tensors of memory in each process
+    :type data_cache_size: int
+
+    :param data_build_processes: Number of processes to build tokenized dialogs into training records with when
+        data_type=`normal`, by default they are built in the training process. The processes are spawned, so the
+        training script has to guard its entry point with `if __name__ == "__main__":`
+    :type data_build_processes: int
+
+    :param dataloader_num_workers: Number of worker processes of the ILQL rollout dataloader, by default batches are
+        collated in the training process. Rollouts are moved into shared memory when workers are used
+    :type dataloader_num_workers: int
+
     :param skip_first_eval: Whether skip first evaluation before training
     :type skip_first_eval: bool
 
@@ -245,6 +258,9 @@ class TrainConfig:
 
     data_type: str = "normal"
     data_size: int = 0
+    data_cache_size: int = 0
+    data_build_processes: int = 0
+    dataloader_num_workers: int = 0
 
     skip_first_eval: bool = False
 
@@ -102,6 +102,12 @@ class ILQLBatch:
     actions_ixs: TensorType["batch_size", "reward_size"]
     dones: TensorType["batch_size", "states_size"]
 
+    def pin_memory(self):
+        """
+        Pin all tensors to page-locked memory, called by `DataLoader` with `pin_memory=True`
+        """
+        return self.__class__(**{k: v.pin_memory() for k, v in self.__dict__.items()})
+
 
 @dataclass
 class ILQLSeq2SeqBatch:
@@ -137,3 +143,9 @@ class ILQLSeq2SeqBatch:
     states_ixs: TensorType["batch_size", "states_size"]
     actions_ixs: TensorType["batch_size", "reward_size"]
     dones: TensorType["batch_size", "states_size"]
+
+    def pin_memory(self):
+        """
+        Pin all tensors to page-locked memory, called by `DataLoader` with `pin_memory=True`
+        """
+        return self.__class__(**{k: v.pin_memory() for k, v in self.__dict__.items()})
@@ -1,15 +1,16 @@
 import logging
-from dataclasses import dataclass
+import multiprocessing
+import os
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
 from typing import Any, Dict, Iterable, List, Tuple, Union
 
+import numpy as np
 import torch
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader
-from transformers import (
-    DataCollatorWithPadding,
-    PreTrainedTokenizer,
-    PreTrainedTokenizerFast,
-)
+from transformers import BatchEncoding, PreTrainedTokenizer, PreTrainedTokenizerFast
 
 from trlx.data.ilql_types import (
     ILQLBatch,
@@ -29,11 +30,11 @@ class DialogMessage:
     :type is_output: bool
 
     :param tokens: Tokenized message
-    :type tokens: Tuple[int]
+    :type tokens: List[int]
     """
 
     is_output: bool
-    tokens: Tuple[int]
+    tokens: List[int]
 
 
 @dataclass
@@ -42,24 +43,25 @@ class PromptMessage:
     Single message in a prompt
 
     :param tokens: Tokenized message
-    :type tokens: Tuple[int]
+    :type tokens: List[int]
 
     :param mask: Mask of tokens
-    :type mask: Tuple[bool]
+    :type mask: List[int]
     """
 
-    tokens: Tuple[int]
-    mask: Tuple[bool]
+    tokens: List[int]
+    mask: List[int]
 
 
 def middle_truncate(tokenized: Union[Iterable[DialogMessage], Iterable[PromptMessage]], max_length: int,
                     truncation_side: str, start_char_token_id: int, end_char_token_id: int, sep_char_token_id: int):
+    is_prompt_message = isinstance(tokenized[0], PromptMessage)
     if isinstance(tokenized[0], DialogMessage):
         # TODO: only support one dialog message for now
         assert len(tokenized) == 2
         prompt_token_num = len(tokenized[0].tokens)
         output_token_num = len(tokenized[1].tokens)
-    elif isinstance(tokenized[0], PromptMessage):
+    elif is_prompt_message:
         # TODO: only support one prompt message for now
         assert len(tokenized) == 1
         prompt_token_num = len(tokenized[0].tokens)
@@ -69,48 +71,64 @@ def middle_truncate(tokenized: Union[Iterable[DialogMessage], Iterable[PromptMes
 
     if prompt_token_num + output_token_num > max_length:
         # only truncate prompt
-        start_char_idx = end_char_idx = -1
-        for i, token_id in enumerate(tokenized[0].tokens):
-            if start_char_idx == -1 and token_id == start_char_token_id:
-                start_char_idx = i
-            if end_char_idx == -1 and token_id == end_char_token_id:
-                end_char_idx = i
-            if start_char_idx != -1 and end_char_idx != -1:
-                break
+        tokens = tokenized[0].tokens
+        try:
+            start_char_idx = tokens.index(start_char_token_id)
+        except ValueError:
+            start_char_idx = -1
+        try:
+            end_char_idx = tokens.index(end_char_token_id, start_char_idx + 1)
+        except ValueError:
+            end_char_idx = -1
         if start_char_idx == -1 or end_char_idx == -1:
             logging.warn("cannot find start_char_token_id[%s] or end_char_token_id[%s] in input_tokens[%s]" %
-                            (start_char_token_id, end_char_token_id, tokenized[0].tokens))
-            start_char_idx, end_char_idx = 0, len(tokenized[0].tokens) - 1
-        middle_token_part = tokenized[0].tokens[start_char_idx+1:end_char_idx]
-        if isinstance(tokenized[0], PromptMessage):
-            middle_mask_part = tokenized[0].mask[start_char_idx+1:end_char_idx]
-        middle_max_len = max_length - output_token_num - (prompt_token_num - len(middle_token_part))
+                            (start_char_token_id, end_char_token_id, tokens))
+            start_char_idx, end_char_idx = 0, len(tokens) - 1
+        # the middle part is tokens[lo:hi], shrunk by whole separated chunks without copying
+        lo, hi = start_char_idx + 1, end_char_idx
+        middle_max_len = max_length - output_token_num - (prompt_token_num - max(hi - lo, 0))
         if middle_max_len < 0:
             raise RuntimeError(("please shorten the prompt or output, max_length: %d, prompt_token_num: %d, " +
                                 "output_token_num: %d, middle_max_len: %d") %
                                 (max_length, prompt_token_num, output_token_num, middle_max_len))
-        if truncation_side == "middle-right":
-            middle_token_part = middle_token_part[::-1]
-            if isinstance(tokenized[0], PromptMessage):
-                middle_mask_part = middle_mask_part[::-1]
-        while len(middle_token_part) > middle_max_len:
-            try:
-                sep_char_idx = middle_token_part.index(sep_char_token_id)
-                middle_token_part = middle_token_part[sep_char_idx+1:]
-                if isinstance(tokenized[0], PromptMessage):
-                    middle_mask_part = middle_mask_part[sep_char_idx+1:]
-            except:
-                middle_token_part = ()
-                if isinstance(tokenized[0], PromptMessage):
-                    middle_mask_part = ()
-                break
-        if truncation_side == "middle-right":
-            middle_token_part = middle_token_part[::-1]
-            if isinstance(tokenized[0], PromptMessage):
-                middle_mask_part = middle_mask_part[::-1]
-        tokenized[0].tokens = tokenized[0].tokens[:start_char_idx+1] + middle_token_part + tokenized[0].tokens[end_char_idx:]
-        if isinstance(tokenized[0], PromptMessage):
-            tokenized[0].mask = tokenized[0].mask[:start_char_idx+1] + middle_mask_part + tokenized[0].mask[end_char_idx:]
+        if hi - lo > middle_max_len:
+            # drop whole separated chunks from one side until the middle part fits, the part becomes empty if
+            # no separator allows that. Separator positions are found in one scan and the cut is binary-searched
+            sep_char_ixs = lo + np.flatnonzero(np.asarray(tokens[lo:hi]) == sep_char_token_id)
+            if truncation_side == "middle-right":
+                # keep everything before the rightmost separator that leaves at most `middle_max_len` tokens
+                k = np.searchsorted(sep_char_ixs, lo + middle_max_len, side="right") - 1
+                hi = int(sep_char_ixs[k]) if k >= 0 else lo
+            else:
+                # keep everything after the leftmost separator that leaves at most `middle_max_len` tokens
+                k = np.searchsorted(sep_char_ixs, hi - 1 - middle_max_len, side="left")
+                lo = int(sep_char_ixs[k]) + 1 if k < len(sep_char_ixs) else hi
+        tokenized[0].tokens = tokens[:start_char_idx+1] + tokens[lo:hi] + tokens[end_char_idx:]
+        if is_prompt_message:
+            mask = tokenized[0].mask
+            tokenized[0].mask = mask[:start_char_idx+1] + mask[lo:hi] + mask[end_char_idx:]
+
+
+def middle_char_token_ids(tokenizer: PreTrainedTokenizer) -> Tuple[int, int, int]:
+    """
+    Token ids of the `middle_start_char`, `middle_end_char` and `middle_sep_char` of the tokenizer used by middle
+    truncation. They are computed on the first call and stored on the tokenizer for all later calls
+    """
+    if not hasattr(tokenizer, "sep_char_token_id"):
+        tokenizer.start_char_token_id = tokenizer(tokenizer.init_kwargs["middle_start_char"]).input_ids[-1]
+        tokenizer.end_char_token_id = tokenizer(tokenizer.init_kwargs["middle_end_char"]).input_ids[-1]
+        tokenizer.sep_char_token_id = tokenizer(tokenizer.init_kwargs["middle_sep_char"]).input_ids[-1]
+    return tokenizer.start_char_token_id, tokenizer.end_char_token_id, tokenizer.sep_char_token_id
+
+
+def _reverse_dialogue(dialogue: List[DialogMessage]):
+    """
+    Reverse the order of messages and the tokens within each message in place
+    """
+    dialogue.reverse()
+    for message in dialogue:
+        message.tokens.reverse()
+
 
 def tokenize_dialogue(  # noqa: C901
     dialogue: Union[str, Iterable[str]], tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast], max_length=2048
@@ -130,112 +148,247 @@ def tokenize_dialogue(  # noqa: C901
         dialogue[-1] = dialogue[-1] + tokenizer.eos_token
 
     tokenized = [
-        DialogMessage(is_output=i % 2 == 1, tokens=tuple(tokenizer(dialogue[i], add_special_tokens=False).input_ids))
+        DialogMessage(is_output=i % 2 == 1, tokens=tokenizer(dialogue[i], add_special_tokens=False).input_ids)
         for i in range(len(dialogue))
     ]
 
+    truncation_side = tokenizer.truncation_side
+    is_left_truncation = truncation_side == "left"
+
     # flip to truncate from the left
-    if tokenizer.truncation_side == "left":
-        tokenized = [DialogMessage(is_output=m.is_output, tokens=m.tokens[::-1]) for m in tokenized[::-1]]
+    if is_left_truncation:
+        _reverse_dialogue(tokenized)
 
-    if tokenizer.truncation_side.startswith("middle"):
-        middle_truncate(tokenized, max_length, tokenizer.truncation_side, tokenizer.start_char_token_id,
+    if truncation_side.startswith("middle"):
+        middle_truncate(tokenized, max_length, truncation_side, tokenizer.start_char_token_id,
                         tokenizer.end_char_token_id, tokenizer.sep_char_token_id)
-        truncated = tokenized
     else:
         # truncate if necessary
         lengths = [len(t.tokens) for t in tokenized]
         cumsum_lengths = [sum(lengths[:i]) for i in range(len(lengths))]
-        truncated = [
-            DialogMessage(is_output=t.is_output, tokens=t.tokens[: max(max_length - cl, 0)])
-            for t, cl in zip(tokenized, cumsum_lengths)
-        ]
+        for t, cl in zip(tokenized, cumsum_lengths):
+            del t.tokens[max(max_length - cl, 0) :]
 
     # flip back if was fliped to left truncate
-    if tokenizer.truncation_side == "left":
-        truncated = [DialogMessage(is_output=m.is_output, tokens=m.tokens[::-1]) for m in truncated[::-1]]
+    if is_left_truncation:
+        _reverse_dialogue(tokenized)
 
     # remove empty messages
-    out = [t for t in truncated if len(t.tokens) > 0]
+    out = [t for t in tokenized if len(t.tokens) > 0]
 
     if out[0].is_output:
         if sum(map(lambda msg: len(msg.tokens), out)) == max_length:
-            if tokenizer.truncation_side == "left":
-                out[0].tokens = out[0].tokens[1:]
+            if is_left_truncation:
+                del out[0].tokens[0]
             else:
-                out[-1].tokens = out[-1].tokens[:-1]
+                del out[-1].tokens[-1]
 
-        out.insert(0, DialogMessage(False, (tokenizer.bos_token_id,)))
+        out.insert(0, DialogMessage(False, [tokenizer.bos_token_id]))
     return out
 
 
+def _build_record(dialog: List[DialogMessage]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flatten a tokenized dialog into arrays of input ids and labels, the latter masking out non-output tokens
+    """
+    input_ids = np.concatenate([np.asarray(m.tokens, dtype=np.int64) for m in dialog])
+    lengths = np.fromiter((len(m.tokens) for m in dialog), dtype=np.int64, count=len(dialog))
+    is_output = np.fromiter((m.is_output for m in dialog), dtype=bool, count=len(dialog))
+    # -100 is the ignore index for CrossEntropyLoss
+    labels = np.where(np.repeat(is_output, lengths), input_ids, -100)
+    return input_ids, labels
+
+
+def dialog_collate_fn(elems: List[dict], pad_token_id: int, padding_side: str = "right") -> BatchEncoding:
+    """
+    Pad `input_ids`, `attention_mask` and `labels` of dialog records into batch tensors sharing the same length
+    """
+    max_length = max(len(e["input_ids"]) for e in elems)
+    input_ids = torch.full((len(elems), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(elems), max_length), dtype=torch.long)
+    # -100 is the ignore index for CrossEntropyLoss
+    labels = torch.full((len(elems), max_length), -100, dtype=torch.long)
+
+    for ix, e in enumerate(elems):
+        length = len(e["input_ids"])
+        span = slice(max_length - length, max_length) if padding_side == "left" else slice(0, length)
+        input_ids[ix, span] = e["input_ids"]
+        attention_mask[ix, span] = e["attention_mask"]
+        labels[ix, span] = e["labels"]
+
+    return BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels})
+
+
 class DialogStore(BaseRolloutStore):
-    def __init__(self, dialogs: List[List[DialogMessage]], tokenizer: PreTrainedTokenizer):
+    """
+    Rollout storage of tokenized dialogs for supervised finetuning
+
+    Args:
+        dialogs (`List[List[DialogMessage]]`): dialogs tokenized with `tokenize_dialogue`.
+        tokenizer (`transformers.PreTrainedTokenizer`): a tokenizer which was used to tokenize dialogs.
+        build_processes (`int`): number of processes to build records with, by default they are built in the
+            current process. Sending dialogs to the processes and records back often costs more than building them,
+            so this only helps for very large datasets. The count is capped by each local rank's share of the cpus.
+            The processes are spawned and import the main module again, so the entry point of the training script
+            has to be guarded with `if __name__ == "__main__":`
+    """
+
+    def __init__(self, dialogs: List[List[DialogMessage]], tokenizer: PreTrainedTokenizer, build_processes: int = 0):
         super().__init__()
         self.tokenizer = tokenizer
-        attention_masks = [torch.ones(sum(len(m.tokens) for m in d), dtype=torch.bool) for d in dialogs]
-        input_ids = [torch.tensor([t for m in d for t in m.tokens], dtype=torch.long) for d in dialogs]
-        # -100 is the ignore index for CrossEntropyLoss
-        labels = [
-            torch.tensor([t if m.is_output else -100 for m in d for t in m.tokens], dtype=torch.long) for d in dialogs
-        ]
-        self.history = [
-            dict(input_ids=i, attention_mask=a, labels=l) for i, a, l in zip(input_ids, attention_masks, labels)
-        ]
+        if build_processes > 0:
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            max_workers = min(build_processes, max((os.cpu_count() or 1) // local_world_size, 1))
+            # processes are spawned rather than forked, since forking after the tokenizer's thread pool or CUDA
+            # have started can deadlock
+            mp_context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+                records = list(executor.map(_build_record, dialogs, chunksize=64))
+        else:
+            records = map(_build_record, dialogs)
 
-    def create_loader(self, batch_size: int, shuffle=False) -> DataLoader:
-        hf_collate_fn = DataCollatorWithPadding(self.tokenizer)
+        self.history = []
+        for input_ids, labels in records:
+            input_ids, labels = torch.from_numpy(input_ids), torch.from_numpy(labels)
+            attention_mask = torch.ones(input_ids.numel(), dtype=torch.bool)
+            self.history.append(dict(input_ids=input_ids, attention_mask=attention_mask, labels=labels))
 
+    def create_loader(self, batch_size: int, shuffle=False) -> DataLoader:
         def collate_fn(elems: Iterable[dict]):
-            batch = hf_collate_fn(
-                {"input_ids": [e["input_ids"] for e in elems], "attention_mask": [e["attention_mask"] for e in elems]}
-            )
-            labels = hf_collate_fn([{"input_ids": e["labels"]} for e in elems])["input_ids"]
-            batch["labels"] = labels
-            return batch
+            return dialog_collate_fn(elems, self.tokenizer.pad_token_id, self.tokenizer.padding_side)
 
-        return DataLoader(self, batch_size=batch_size, collate_fn=collate_fn, shuffle=shuffle)
+        return DataLoader(
+            self,
+            batch_size=batch_size,
+            collate_fn=collate_fn,
+            shuffle=shuffle,
+            pin_memory=torch.cuda.is_available(),
+        )
 
 
 class DialogStreamStore(BaseRolloutStreamStore):
+    """
+    Rollout storage which tokenizes dialogs lazily on access, for datasets too large to be tokenized upfront
+
+    Args:
+        dialogs_iter (`List[List[DialogMessage]]`): indexable source of raw dialogs.
+        data_size (`int`): number of dialogs in `dialogs_iter`.
+        tokenizer (`transformers.PreTrainedTokenizer`): a tokenizer to tokenize dialogs with.
+        seq_length (`int`): max length of a tokenized dialog.
+        cache_size (`int`): number of tokenized samples to keep in an LRU cache keyed by index, disabled by default.
+            Each cached sample holds three tensors of up to `seq_length` elements in every process, so a large cache
+            costs gigabytes of memory, and it only pays off when the same indices are revisited before eviction
+    """
+
     def __init__(self, dialogs_iter: List[List[DialogMessage]], data_size: int,
-                 tokenizer: PreTrainedTokenizer, seq_length: int):
+                 tokenizer: PreTrainedTokenizer, seq_length: int, cache_size: int = 0):
         super().__init__(dialogs_iter, data_size)
         self.tokenizer = tokenizer
         self.seq_length = seq_length
+        # tokenization is deterministic, so revisited samples can be served from the cache. The cache is a plain
+        # attribute, which keeps the store picklable for dataloader workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
         if self.tokenizer.truncation_side.startswith("middle"):
             assert "middle_start_char" in self.tokenizer.init_kwargs
             assert "middle_end_char" in self.tokenizer.init_kwargs
             assert "middle_sep_char" in self.tokenizer.init_kwargs
-            start_char_token_id = self.tokenizer(self.tokenizer.init_kwargs["middle_start_char"]).input_ids[-1]
-            end_char_token_id = self.tokenizer(self.tokenizer.init_kwargs["middle_end_char"]).input_ids[-1]
-            sep_char_token_id = self.tokenizer(self.tokenizer.init_kwargs["middle_sep_char"]).input_ids[-1]
-            setattr(self.tokenizer, "start_char_token_id", start_char_token_id)
-            setattr(self.tokenizer, "end_char_token_id", end_char_token_id)
-            setattr(self.tokenizer, "sep_char_token_id", sep_char_token_id)
+            middle_char_token_ids(self.tokenizer)
 
     def __getitem__(self, index: int):
+        if self.cache_size <= 0:
+            return self._getitem(index)
+
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        record = self._cache[index] = self._getitem(index)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return record
+
+    def _getitem(self, index: int):
         sample = self.iterator.__getitem__(index)
         dialog = tokenize_dialogue(sample, self.tokenizer, self.seq_length)
-        attention_mask = torch.ones(sum(len(m.tokens) for m in dialog), dtype=torch.bool)
-        input_id = torch.tensor([t for m in dialog for t in m.tokens], dtype=torch.long)
-        # -100 is the ignore index for CrossEntropyLoss
-        labels = torch.tensor([t if m.is_output else -100 for m in dialog for t in m.tokens], dtype=torch.long)
-        data = dict(input_ids=input_id, attention_mask=attention_mask, labels=labels)
-        return data
+        input_ids, labels = _build_record(dialog)
+        input_ids, labels = torch.from_numpy(input_ids), torch.from_numpy(labels)
+        attention_mask = torch.ones(input_ids.numel(), dtype=torch.bool)
+        return dict(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
 
     def create_loader(self, batch_size: int, shuffle=False) -> DataLoader:
-        hf_collate_fn = DataCollatorWithPadding(self.tokenizer)
-
         def collate_fn(elems: Iterable[dict]):
-            batch = hf_collate_fn(
-                {"input_ids": [e["input_ids"] for e in elems], "attention_mask": [e["attention_mask"] for e in elems]}
-            )
-            labels = hf_collate_fn([{"input_ids": e["labels"]} for e in elems])["input_ids"]
-            batch["labels"] = labels
-            return batch
+            return dialog_collate_fn(elems, self.tokenizer.pad_token_id, self.tokenizer.padding_side)
+
+        return DataLoader(
+            self,
+            batch_size=batch_size,
+            collate_fn=collate_fn,
+            shuffle=shuffle,
+            pin_memory=torch.cuda.is_available(),
+        )
 
-        return DataLoader(self, batch_size=batch_size, collate_fn=collate_fn, shuffle=shuffle)
+
+# Prompt encodings of each tokenizer, which are reused by `PromptPipeline`s created with `cache_encodings=True`
+# and dropped together with the tokenizer
+_prompt_encodings = weakref.WeakKeyDictionary()
+
+
+def _encode_prompts(
+    prompts: List[str],
+    max_prompt_length: int,
+    tokenizer: PreTrainedTokenizer,
+    add_special_tokens: bool,
+    cache_encodings: bool = False,
+) -> Dict[str, Tuple[List[int], List[int]]]:
+    """
+    Map distinct prompts to their truncated input ids and attention mask, only encoding those which are not cached
+    """
+    cache = _prompt_encodings.setdefault(tokenizer, {}) if cache_encodings else {}
+    settings = (tokenizer.truncation_side, add_special_tokens, max_prompt_length)
+    encodings = {}
+    missing_prompts = []
+    for prompt in prompts:
+        cached = cache.get((*settings, prompt))
+        if cached is None:
+            missing_prompts.append(prompt)
+        else:
+            # cached encodings are immutable, every pipeline gets lists of its own
+            encodings[prompt] = (list(cached[0]), list(cached[1]))
+
+    if not missing_prompts:
+        return encodings
+
+    if tokenizer.truncation_side.startswith("middle"):
+        start_char_token_id, end_char_token_id, sep_char_token_id = middle_char_token_ids(tokenizer)
+        prompts_tokens = []
+        attention_mask = []
+        # middle truncation operates on raw tokens, so encode the whole batch at once without special tokens
+        model_inputs = tokenizer(missing_prompts, add_special_tokens=False)
+        for ids, mask in zip(model_inputs["input_ids"], model_inputs["attention_mask"]):
+            tokenized = [PromptMessage(tokens=ids, mask=mask)]
+            middle_truncate(tokenized, max_prompt_length, tokenizer.truncation_side,
+                            start_char_token_id, end_char_token_id, sep_char_token_id)
+            prompts_tokens.append(tokenized[0].tokens)
+            attention_mask.append(tokenized[0].mask)
+    else:
+        model_inputs = tokenizer(
+            missing_prompts,
+            truncation=True,
+            padding=False,
+            max_length=max_prompt_length,
+            add_special_tokens=add_special_tokens,
+        )
+
+        prompts_tokens = model_inputs["input_ids"]
+        attention_mask = model_inputs["attention_mask"]
+
+    for prompt, ids, mask in zip(missing_prompts, prompts_tokens, attention_mask):
+        encodings[prompt] = (ids, mask)
+        if cache_encodings:
+            cache[(*settings, prompt)] = (tuple(ids), tuple(mask))
+
+    return encodings
 
 
 @register_datapipeline
@@ -252,6 +405,9 @@ class PromptPipeline(BasePipeline):
         tokenizer (`transformers.PreTrainedTokenizer`): a tokenizer to tokenize prompts with.
         add_special_tokens (`bool`): whether to encode prompts with tokenizer's special tokens (passed directly
             into `tokenizer.encode`)
+        cache_encodings (`bool`): whether to reuse encodings of prompts from other pipelines created with this
+            option and the same tokenizer, and to keep the encodings of these prompts for later ones. They are kept
+            for as long as the tokenizer is alive, which may take a lot of memory for many long prompts
     """
 
     def __init__(
@@ -260,6 +416,7 @@ class PromptPipeline(BasePipeline):
         max_prompt_length: int,
         tokenizer: PreTrainedTokenizer,
         add_special_tokens: bool = False,
+        cache_encodings: bool = False,
     ):
         super().__init__()
 
@@ -269,43 +426,37 @@ class PromptPipeline(BasePipeline):
         else:
             metadata = [{}] * len(prompts)
 
-        if tokenizer.truncation_side.startswith("middle"):
-            start_char_token_id = tokenizer(tokenizer.init_kwargs["middle_start_char"]).input_ids[-1]
-            end_char_token_id = tokenizer(tokenizer.init_kwargs["middle_end_char"]).input_ids[-1]
-            sep_char_token_id = tokenizer(tokenizer.init_kwargs["middle_sep_char"]).input_ids[-1]
-            prompts_tokens = []
-            attention_mask = []
-            for prompt in prompts:
-                result = tokenizer(prompt, add_special_tokens=False)
-                tokenized = [PromptMessage(tokens=tuple(result.input_ids), mask=tuple(result.attention_mask))]
-                middle_truncate(tokenized, max_prompt_length, tokenizer.truncation_side,
-                                start_char_token_id, end_char_token_id, sep_char_token_id)
-                prompts_tokens.append(list(tokenized[0].tokens))
-                attention_mask.append(list(tokenized[0].mask))
-        else:
-            model_inputs = tokenizer(
-                prompts, truncation=True, padding=False, max_length=max_prompt_length, add_special_tokens=add_special_tokens
-            )
-
-            prompts_tokens = model_inputs["input_ids"]
-            attention_mask = model_inputs["attention_mask"]
+        # encode every distinct prompt only once, repeated prompts share their tokens afterwards
+        unique_prompts = list(dict.fromkeys(prompts))
+        encodings = _encode_prompts(unique_prompts, max_prompt_length, tokenizer, add_special_tokens, cache_encodings)
+        prompts_tokens = [encodings[prompt][0] for prompt in prompts]
+        attention_mask = [encodings[prompt][1] for prompt in prompts]
 
         self.tokenizer = tokenizer
-        self.prompts = [
-            {"input_ids": tokens, "attention_mask": mask, **metadata}
-            for tokens, mask, metadata in zip(prompts_tokens, attention_mask, metadata)
-        ]
+        # columns are kept separately and only assembled into a record on access
+        self.input_ids = prompts_tokens
+        self.attention_mask = attention_mask
+        self.metadata = metadata
 
     def __getitem__(self, ix: int):
-        return self.prompts[ix]
+        return {"input_ids": self.input_ids[ix], "attention_mask": self.attention_mask[ix], **self.metadata[ix]}
 
     def __len__(self) -> int:
-        return len(self.prompts)
+        return len(self.input_ids)
 
     def create_loader(self, batch_size: int, shuffle=False, sampler=None, drop_last=False) -> DataLoader:
         def collate_fn(xs):
-            out = self.tokenizer.pad([{"input_ids": x["input_ids"]} for x in xs], return_tensors="pt")
-
+            max_length = max(len(x["input_ids"]) for x in xs)
+            input_ids = torch.full((len(xs), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(xs), max_length), dtype=torch.long)
+            left_padding = self.tokenizer.padding_side == "left"
+            for ix, x in enumerate(xs):
+                length = len(x["input_ids"])
+                span = slice(max_length - length, max_length) if left_padding else slice(0, length)
+                input_ids[ix, span] = torch.as_tensor(x["input_ids"], dtype=torch.long)
+                attention_mask[ix, span] = 1
+
+            out = BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask})
             for key in xs[0]:
                 if key != "input_ids" and key != "attention_mask":
                     out[key] = [x[key] for x in xs]
@@ -322,18 +473,63 @@ class PromptPipeline(BasePipeline):
             sampler=sampler,
             num_workers=0,
             drop_last=drop_last,
+            pin_memory=torch.cuda.is_available(),
         )
 
 
+def _pad_elements(elems: List[Any], batch_type: type) -> Any:
+    """
+    Right-pad each field of `elems` with zeros and collect them into `batch_type`, which has to list the same
+    fields as the elements. Every padded tensor is allocated once and filled in a single pass over the elements
+    """
+    names = [f.name for f in fields(batch_type)]
+    padded = []
+    for name in names:
+        column = [getattr(x, name) for x in elems]
+        max_length = max(t.size(0) for t in column)
+        padded.append(column[0].new_zeros((len(elems), max_length, *column[0].shape[1:])))
+
+    for ix, x in enumerate(elems):
+        for name, out in zip(names, padded):
+            t = getattr(x, name)
+            out[ix, : t.size(0)] = t
+
+    return batch_type(*padded)
+
+
 def ilql_collate_fn(elems: Iterable[ILQLElement]):
-    return ILQLBatch(
-        pad_sequence([x.input_ids for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.attention_mask for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.rewards for x in elems], batch_first=True, padding_value=0.0),
-        pad_sequence([x.states_ixs for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.actions_ixs for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.dones for x in elems], batch_first=True, padding_value=0),
-    )
+    return _pad_elements(elems, ILQLBatch)
+
+
+def _flatten_rows(rows: Iterable[torch.Tensor]) -> Tuple[torch.Tensor, List[int]]:
+    """
+    Concatenate rows into a single flat tensor and return it together with the offsets of the rows in it, so that
+    the `ix`-th row is `flat[offsets[ix] : offsets[ix + 1]]`
+    """
+    rows = list(rows)
+    offsets = [0]
+    for row in rows:
+        offsets.append(offsets[-1] + row.size(0))
+    return torch.cat(rows), offsets
+
+
+def _share_memory(storage: BaseRolloutStore):
+    """
+    Move the flattened fields of `storage` into shared memory, so that dataloader workers read them without keeping
+    copies of their own
+    """
+    for name in storage.offsets:
+        tensor = getattr(storage, name)
+        if not tensor.is_shared():
+            tensor.share_memory_()
+
+
+def _get_row(storage: BaseRolloutStore, name: str, ix: int) -> torch.Tensor:
+    """
+    View of the `ix`-th row of the flattened field `name` in `storage`
+    """
+    offsets = storage.offsets[name]
+    return getattr(storage, name)[offsets[ix] : offsets[ix + 1]]
 
 
 class ILQLRolloutStorage(BaseRolloutStore):
@@ -344,46 +540,48 @@ class ILQLRolloutStorage(BaseRolloutStore):
     def __init__(self, input_ids, attention_mask, rewards, states_ixs, actions_ixs, dones):
         super().__init__()
 
-        self.input_ids = input_ids
-        self.attention_mask = attention_mask
-        self.rewards = rewards
-        self.states_ixs = states_ixs
-        self.actions_ixs = actions_ixs
-        self.dones = dones
+        # rollouts are kept as flat tensors without padding, which is only added to the collated batches
+        self.offsets = {}
+        self.input_ids, self.offsets["input_ids"] = _flatten_rows(input_ids)
+        self.attention_mask, self.offsets["attention_mask"] = _flatten_rows(attention_mask)
+        self.rewards, self.offsets["rewards"] = _flatten_rows(rewards)
+        self.states_ixs, self.offsets["states_ixs"] = _flatten_rows(states_ixs)
+        self.actions_ixs, self.offsets["actions_ixs"] = _flatten_rows(actions_ixs)
+        self.dones, self.offsets["dones"] = _flatten_rows(dones)
+        # uneven last batches would desynchronize ranks, so they are dropped in distributed runs
+        self._drop_last = torch.distributed.is_initialized()
 
     def __getitem__(self, ix: int) -> ILQLElement:
         return ILQLElement(
-            self.input_ids[ix],
-            self.attention_mask[ix],
-            self.rewards[ix],
-            self.states_ixs[ix],
-            self.actions_ixs[ix],
-            self.dones[ix],
+            _get_row(self, "input_ids", ix),
+            _get_row(self, "attention_mask", ix),
+            _get_row(self, "rewards", ix),
+            _get_row(self, "states_ixs", ix),
+            _get_row(self, "actions_ixs", ix),
+            _get_row(self, "dones", ix),
         )
 
     def __len__(self) -> int:
-        return len(self.input_ids)
+        return len(self.offsets["input_ids"]) - 1
+
+    def create_loader(self, batch_size: int, num_workers: int = 0):
+        if num_workers > 0:
+            _share_memory(self)
 
-    def create_loader(self, batch_size: int):
         return DataLoader(
             self,
             batch_size=batch_size,
             shuffle=True,
             collate_fn=ilql_collate_fn,
-            drop_last=torch.distributed.is_initialized(),
+            drop_last=self._drop_last,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=torch.cuda.is_available(),
         )
 
 
-def ilql_seq2seq_collate_fn(elems: Iterable[ILQLElement]):
-    return ILQLSeq2SeqBatch(
-        pad_sequence([x.input_ids for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.attention_mask for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.decoder_input_ids for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.rewards for x in elems], batch_first=True, padding_value=0.0),
-        pad_sequence([x.states_ixs for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.actions_ixs for x in elems], batch_first=True, padding_value=0),
-        pad_sequence([x.dones for x in elems], batch_first=True, padding_value=0),
-    )
+def ilql_seq2seq_collate_fn(elems: Iterable[ILQLSeq2SeqElement]):
+    return _pad_elements(elems, ILQLSeq2SeqBatch)
 
 
 class ILQLSeq2SeqRolloutStorage(BaseRolloutStore):
@@ -394,33 +592,43 @@ class ILQLSeq2SeqRolloutStorage(BaseRolloutStore):
     def __init__(self, input_ids, attention_mask, decoder_input_ids, rewards, states_ixs, actions_ixs, dones):
         super().__init__()
 
-        self.input_ids = input_ids
-        self.attention_mask = attention_mask
-        self.decoder_input_ids = decoder_input_ids
-        self.rewards = rewards
-        self.states_ixs = states_ixs
-        self.actions_ixs = actions_ixs
-        self.dones = dones
-
-    def __getitem__(self, ix: int) -> ILQLElement:
+        # rollouts are kept as flat tensors without padding, which is only added to the collated batches
+        self.offsets = {}
+        self.input_ids, self.offsets["input_ids"] = _flatten_rows(input_ids)
+        self.attention_mask, self.offsets["attention_mask"] = _flatten_rows(attention_mask)
+        self.decoder_input_ids, self.offsets["decoder_input_ids"] = _flatten_rows(decoder_input_ids)
+        self.rewards, self.offsets["rewards"] = _flatten_rows(rewards)
+        self.states_ixs, self.offsets["states_ixs"] = _flatten_rows(states_ixs)
+        self.actions_ixs, self.offsets["actions_ixs"] = _flatten_rows(actions_ixs)
+        self.dones, self.offsets["dones"] = _flatten_rows(dones)
+        # uneven last batches would desynchronize ranks, so they are dropped in distributed runs
+        self._drop_last = torch.distributed.is_initialized()
+
+    def __getitem__(self, ix: int) -> ILQLSeq2SeqElement:
         return ILQLSeq2SeqElement(
-            self.input_ids[ix],
-            self.attention_mask[ix],
-            self.decoder_input_ids[ix],
-            self.rewards[ix],
-            self.states_ixs[ix],
-            self.actions_ixs[ix],
-            self.dones[ix],
+            _get_row(self, "input_ids", ix),
+            _get_row(self, "attention_mask", ix),
+            _get_row(self, "decoder_input_ids", ix),
+            _get_row(self, "rewards", ix),
+            _get_row(self, "states_ixs", ix),
+            _get_row(self, "actions_ixs", ix),
+            _get_row(self, "dones", ix),
         )
 
     def __len__(self) -> int:
-        return len(self.input_ids)
+        return len(self.offsets["input_ids"]) - 1
+
+    def create_loader(self, batch_size: int, num_workers: int = 0):
+        if num_workers > 0:
+            _share_memory(self)
 
-    def create_loader(self, batch_size: int):
         return DataLoader(
             self,
             batch_size=batch_size,
             shuffle=True,
             collate_fn=ilql_seq2seq_collate_fn,
-            drop_last=torch.distributed.is_initialized(),
+            drop_last=self._drop_last,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=torch.cuda.is_available(),
         )
@@ -43,7 +43,7 @@ def make_experience(samples, rewards, tokenizer=None, max_length=2048, verbose=T
     all_dones = []
     for sample in samples:
         length = 0
-        all_input_ids.append(torch.tensor(sum((s.tokens for s in sample), ())))
+        all_input_ids.append(torch.tensor([t for s in sample for t in s.tokens]))
         actions_ixs = []
         for dm in sample:
             if dm.is_output:
@@ -140,7 +140,8 @@ class AccelerateILQLTrainer(AccelerateRLTrainer):
             self.accelerator.unwrap_model(self.model).sync_target_q_heads()
 
     def loss(self, batch: Union[ILQLBatch, ILQLSeq2SeqBatch]):
-        batch = to_device(batch, self.accelerator.device)
+        # batches come from pinned memory, so the host to device copy can be asynchronous
+        batch = to_device(batch, self.accelerator.device, non_blocking=True)
         if self.config.model.model_arch_type == "seq2seq":
             logits, qs, target_qs, vs, _, _ = self.model(
                 input_ids=batch.input_ids,
@@ -160,7 +161,9 @@ class AccelerateILQLTrainer(AccelerateRLTrainer):
         return self.ilql.loss((logits, (qs, target_qs, vs)), batch)
 
     def create_train_dataloader(self):
-        return self.accelerator.prepare(self.store.create_loader(self.config.train.batch_size))
+        return self.accelerator.prepare(
+            self.store.create_loader(self.config.train.batch_size, num_workers=self.config.train.dataloader_num_workers)
+        )
 
     def prepare_learning(self):
         self.train_dataloader = self.create_train_dataloader()
@@ -39,6 +39,8 @@ class AccelerateSFTTrainer(AccelerateRLTrainer):
         )
         self.data_type = config.train.data_type
         self.data_size = config.train.data_size
+        self.data_cache_size = config.train.data_cache_size
+        self.data_build_processes = config.train.data_build_processes
 
     def get_arch(self, config):
         from_fn = AutoModelForCausalLM.from_pretrained
@@ -100,10 +102,11 @@ class AccelerateSFTTrainer(AccelerateRLTrainer):
         if self.data_type == "stream":
             # samples is a iterator in `stream` data_type
             self.store = DialogStreamStore(dialogs_iter=samples, data_size=self.data_size,
-                                           tokenizer=self.tokenizer, seq_length=seq_length)
+                                           tokenizer=self.tokenizer, seq_length=seq_length,
+                                           cache_size=self.data_cache_size)
             return
         if isinstance(samples[0], str):
             self.store = PromptPipeline(samples, seq_length, self.tokenizer)
         else:
             dialogs = [tokenize_dialogue(d, self.tokenizer, seq_length) for d in samples]
-            self.store = DialogStore(dialogs, self.tokenizer)
+            self.store = DialogStore(dialogs, self.tokenizer, build_processes=self.data_build_processes)